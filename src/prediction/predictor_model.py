@@ -1,7 +1,6 @@
 import os
 import sys
 import warnings
-from typing import Callable
 import math
 
 import joblib
@@ -12,36 +11,47 @@ warnings.filterwarnings("ignore")
 
 import torch
 import torch as T
+import torch.distributed as dist
 import torch.optim as optim
-from torch.nn import Flatten, Conv1d, ReLU, Linear, Module, MSELoss
-from torch.utils.data import Dataset, DataLoader
+from torch.nn import Conv1d, Identity, Linear, Module, ReLU, Tanh
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import BatchSampler, Dataset, DataLoader, SequentialSampler
 import torch.nn.functional as F
 
+# allow TF32 matmuls for the final Linear layer on Ampere+ GPUs
+torch.set_float32_matmul_precision("high")
 
 # Check for GPU availability
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 print("device used: ", device)
+# page-locked host memory lets host-to-device copies run asynchronously
+PIN_MEMORY = device != "cpu"
+# mixed precision training runs the convolutions on Tensor Cores
+USE_AMP = device.startswith("cuda")
 
 PREDICTOR_FILE_NAME = "predictor.joblib"
 MODEL_PARAMS_FNAME = "model_params.save"
 MODEL_WTS_FNAME = "model_wts.save"
 HISTORY_FNAME = "history.json"
 COST_THRESHOLD = float("inf")
+# version of the Net weight layout; bump when saved weights become incompatible.
+# 2: fc inputs are ordered channel-major instead of time-major
+NET_LAYOUT_VERSION = 2
 
 
-def get_activation(activation: str) -> Callable:
+def get_activation(activation: str) -> Module:
     """
-    Return the activation function based on the input string.
+    Return the activation module based on the input string.
 
-    This function returns a callable activation function from the
-    torch.nn.functional package.
+    Modules (rather than functional callables) are traced cleanly by
+    torch.compile as part of the network graph.
 
     Args:
         activation (str): Name of the activation function.
 
     Returns:
-        Callable: The requested activation function. If 'none' is specified,
-        it will return an identity function.
+        Module: The requested activation module. If 'none' is specified,
+        it will return an identity module.
 
     Raises:
         Exception: If the activation string does not match any known
@@ -49,11 +59,11 @@ def get_activation(activation: str) -> Callable:
 
     """
     if activation == "tanh":
-        return F.tanh
+        return Tanh()
     elif activation == "relu":
-        return F.relu
+        return ReLU()
     elif activation == "none":
-        return lambda x: x  # Identity function, doesn't change input
+        return Identity()  # doesn't change input
     else:
         raise ValueError(
             f"Error: Unrecognized activation type: {activation}. "
@@ -61,6 +71,80 @@ def get_activation(activation: str) -> Callable:
         )
 
 
+class CompiledNet(Module):
+    """Run a network compiled with torch.compile, falling back to eager on errors.
+
+    Dynamo's `suppress_errors` is only enabled while this network runs, so
+    compilation failures elsewhere in the process are still raised.
+    """
+
+    def __init__(self, net: Module):
+        super().__init__()
+        self._orig_mod = net
+        # not registered as a submodule so parameters and state are not duplicated
+        self.__dict__["_compiled"] = torch.compile(
+            net, mode="reduce-overhead", fullgraph=False
+        )
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        with torch._dynamo.config.patch(suppress_errors=True):
+            return self._compiled(X)
+
+
+def compile_net(net: Module) -> Module:
+    """
+    Compile the network with TorchInductor to fuse its kernels.
+
+    Compilation is only attempted on CUDA devices, where "reduce-overhead" mode
+    also captures CUDA graphs to remove per-op launch overhead. If torch.compile
+    is unavailable (e.g. PyTorch < 2.0), the network is scripted with TorchScript
+    instead, which still fuses the pointwise tail of the forward pass. If dynamo
+    fails at the first call, or scripting fails, the eager network is used.
+
+    Args:
+        net (Module): The network to compile. Must already be on `device`.
+
+    Returns:
+        Module: The compiled or scripted network, or the eager network as fallback.
+    """
+    if not device.startswith("cuda"):
+        return net
+    try:
+        return CompiledNet(net)
+    except Exception as exc:
+        print(f"torch.compile unavailable, falling back to TorchScript: {exc}")
+    try:
+        return torch.jit.script(net)
+    except Exception as exc:
+        print(f"torch.jit.script failed, using eager mode: {exc}")
+        return net
+
+
+def unwrap_net(net: Module) -> Module:
+    """Return the underlying network of a (possibly) compiled or DDP network."""
+    net = getattr(net, "_orig_mod", net)
+    if isinstance(net, DistributedDataParallel):
+        net = net.module
+    return net
+
+
+def setup_distributed() -> int:
+    """
+    Initialize the NCCL process group for multi-GPU training.
+
+    Expects to be launched with `torchrun`, which sets the rank and world size
+    environment variables for every process.
+
+    Returns:
+        int: The local rank of this process, i.e. the index of its GPU.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group("nccl")
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    return local_rank
+
+
 def get_patience_factor(N):
     # magic number - just picked through trial and error
     if N < 100:
@@ -69,19 +153,29 @@ def get_patience_factor(N):
     return patience
 
 
-def get_loss(model, device, data_loader, loss_function):
+def get_loss(model, device, data_loader):
     model.eval()
-    loss_total = 0
-    with torch.no_grad():
+    # accumulate on the device so there is a single host sync at the end
+    loss_total = torch.zeros((), device=device)
+    num_samples = 0
+    with torch.inference_mode():
         for data in data_loader:
-            X, y = data[0].to(device), data[1].to(device)
+            X = data[0].to(device, non_blocking=True)
+            y = data[1].to(device, non_blocking=True)
             output = model(X)
-            loss = loss_function(y, output)
-            loss_total += loss.item()
-    return loss_total / len(data_loader)
+            # weight by batch size so a partial last batch is averaged correctly
+            loss_total += F.mse_loss(output, y) * X.size(0)
+            num_samples += X.size(0)
+    return (loss_total / num_samples).item()
 
 
 class CustomDataset(Dataset):
+    """Dataset over stacked tensors.
+
+    Indexing with a list of indices slices a whole batch at once, so it can be
+    paired with a `BatchSampler` to skip per-sample fetching and collation.
+    """
+
     def __init__(self, x, y=None):
         self.x = x
         self.y = y
@@ -96,12 +190,66 @@ class CustomDataset(Dataset):
         return len(self.x)
 
 
+class DeviceBatchLoader:
+    """Iterate over minibatches of tensors that already live on the device.
+
+    Used in place of a DataLoader when the whole dataset fits in device memory,
+    so batches are gathered by on-device indexing without host-to-device copies.
+
+    For distributed training, each of the `num_replicas` processes iterates over
+    its own equally sized shard of a permutation shared by all processes, like
+    `DistributedSampler` does. Call `set_epoch` every epoch to reshuffle.
+    """
+
+    def __init__(self, x, y, batch_size, shuffle=True, rank=0, num_replicas=1):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _get_indices(self):
+        N = len(self.x)
+        if self.num_replicas == 1:
+            if self.shuffle:
+                return torch.randperm(N, device=self.x.device)
+            return torch.arange(N, device=self.x.device)
+        if self.shuffle:
+            # seed by epoch so that all processes draw the same permutation
+            generator = torch.Generator().manual_seed(self.epoch)
+            indices = torch.randperm(N, generator=generator)
+        else:
+            indices = torch.arange(N)
+        # wrap around so that every process gets the same number of batches
+        total_size = math.ceil(N / self.num_replicas) * self.num_replicas
+        indices = indices.repeat(math.ceil(total_size / N))[:total_size]
+        return indices[self.rank :: self.num_replicas].to(self.x.device)
+
+    def __iter__(self):
+        indices = self._get_indices()
+        for start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[start : start + self.batch_size]
+            yield self.x[batch_indices], self.y[batch_indices]
+
+    def __len__(self):
+        num_samples = math.ceil(len(self.x) / self.num_replicas)
+        return math.ceil(num_samples / self.batch_size)
+
+
 class Net(Module):
     def __init__(self, feat_dim, encode_len, decode_len, activation):
         super(Net, self).__init__()
         self.feat_dim = feat_dim
         self.encode_len = encode_len
         self.decode_len = decode_len
+        # "same" padding keeps the conv output at encode_len steps, so the
+        # forecast window always starts at this fixed offset
+        self._tail_start = encode_len - decode_len
         self.activation = get_activation(activation)
 
         dim1 = 100
@@ -133,29 +281,21 @@ class Net(Module):
             in_features=dim3 * self.decode_len,
             out_features=self.decode_len,
         )
-        self.flatten = Flatten()
 
-    def forward(self, X):
-        x = X.permute(0, 2, 1)
-        x = self.conv1(x)
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        # X is expected in the contiguous (N, feat_dim, encode_len) layout
+        x = self.conv1(X)
         x = self.conv2(x)
         x = self.conv3(x)
-        x = x.permute(0, 2, 1)
-        x = x[:, -self.decode_len:, :]
-        x = self.flatten(x)
-        x = self.activation(x)
+        # keep the channel-major conv layout; the fc weights are learned against it
+        x = x.narrow(2, self._tail_start, self.decode_len)
+        x = self.activation(x).reshape(x.size(0), -1)
         x = self.fc(x)
         out = x
         return out
 
     def get_num_parameters(self):
-        pp = 0
-        for p in list(self.parameters()):
-            nn = 1
-            for s in list(p.size()):
-                nn = nn * s
-            pp += nn
-        return pp
+        return sum(p.numel() for p in self.parameters())
 
 
 class Forecaster:
@@ -168,14 +308,34 @@ class Forecaster:
     MODEL_NAME = "CNN_Timeseries_Forecaster"
 
     def __init__(
-        self, encode_len: int, decode_len: int, feat_dim: int, activation: str, **kwargs
+        self,
+        encode_len: int,
+        decode_len: int,
+        feat_dim: int,
+        activation: str,
+        distributed: bool = False,
+        **kwargs,
     ):
-        """Construct a new CNN Forecaster."""
+        """Construct a new CNN Forecaster.
+
+        Set `distributed` to True to train with DistributedDataParallel across
+        the GPUs of a `torchrun` launch.
+        """
         self.encode_len = encode_len
         self.decode_len = decode_len
         self.feat_dim = feat_dim
         self.activation = activation
         self.batch_size = 64
+        self.distributed = distributed
+        if self.distributed:
+            local_rank = setup_distributed()
+            self.device = f"cuda:{local_rank}"
+            self.rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+        else:
+            self.device = device
+            self.rank = 0
+            self.world_size = 1
 
         print("encode_len/decode_len", encode_len, decode_len)
 
@@ -186,15 +346,30 @@ class Forecaster:
             activation=self.activation,
         )
 
-        self.net.to(device)
-        self.criterion = MSELoss()
-        self.optimizer = optim.Adam(self.net.parameters())
+        self.net.to(self.device)
+        if self.distributed:
+            self.net = DistributedDataParallel(
+                self.net, device_ids=[local_rank], bucket_cap_mb=25
+            )
+        self.net = compile_net(self.net)
+        # the fused implementation updates all parameters in a single CUDA kernel
+        self.optimizer = optim.Adam(
+            self.net.parameters(), fused=self.device.startswith("cuda")
+        )
+        self.scaler = torch.cuda.amp.GradScaler(enabled=USE_AMP)
         self.print_period = 1
 
+        # staging buffers for streaming prediction batches to the GPU,
+        # allocated on the first call to predict()
+        self._pin_buf, self._gpu_buf, self._copy_stream = None, None, None
+
     def _get_X_and_y(self, data: np.ndarray, is_train: bool = True) -> np.ndarray:
         """Extract X (historical target series), y (forecast window target)
         When is_train is True, data contains both history and forecast windows.
         When False, only history is contained.
+        X is returned in the (N, D, encode_len) channels-first layout expected
+        by the Conv1d layers of the network. X and y are contiguous float32
+        arrays, so they can be shared with torch via `torch.from_numpy`.
         """
         N, T, D = data.shape
         if D != self.feat_dim:
@@ -208,8 +383,10 @@ class Forecaster:
                     f"Training data expected to have {self.encode_len + self.decode_len}"
                     f" length on axis 1. Found length {T}"
                 )
-            X = data[:, : self.encode_len, :]
-            y = data[:, self.encode_len :, 0]
+            X = np.ascontiguousarray(
+                data[:, : self.encode_len, :].transpose(0, 2, 1), dtype=np.float32
+            )
+            y = np.ascontiguousarray(data[:, self.encode_len :, 0], dtype=np.float32)
         else:
             # for inference
             if T < self.encode_len:
@@ -217,7 +394,9 @@ class Forecaster:
                     f"Inference data length expected to be >= {self.encode_len}"
                     f" on axis 1. Found length {T}"
                 )
-            X = data[:, -self.encode_len :, :]
+            X = np.ascontiguousarray(
+                data[:, -self.encode_len :, :].transpose(0, 2, 1), dtype=np.float32
+            )
             y = None
         return X, y
 
@@ -232,19 +411,23 @@ class Forecaster:
         patience = get_patience_factor(train_X.shape[0])
         # print(f"{patience=}")
 
-        train_X, train_y = torch.FloatTensor(train_X), torch.FloatTensor(train_y)
-        train_dataset = CustomDataset(train_X, train_y)
-        train_loader = DataLoader(
-            dataset=train_dataset,
+        # the datasets are small, so move them to the device once up front
+        train_X = torch.from_numpy(train_X).to(self.device)
+        train_y = torch.from_numpy(train_y).to(self.device)
+        train_loader = DeviceBatchLoader(
+            train_X,
+            train_y,
             batch_size=int(self.batch_size),
-            shuffle=True
+            shuffle=True,
+            rank=self.rank,
+            num_replicas=self.world_size,
         )
 
         if valid_X is not None and valid_y is not None:
-            valid_X, valid_y = torch.FloatTensor(valid_X), torch.FloatTensor(valid_y)
-            valid_dataset = CustomDataset(valid_X, valid_y)
-            valid_loader = DataLoader(
-                dataset=valid_dataset, batch_size=int(self.batch_size), shuffle=True
+            valid_X = torch.from_numpy(valid_X).to(self.device)
+            valid_y = torch.from_numpy(valid_y).to(self.device)
+            valid_loader = DeviceBatchLoader(
+                valid_X, valid_y, batch_size=int(self.batch_size), shuffle=False
             )
         else:
             valid_loader = None
@@ -259,6 +442,18 @@ class Forecaster:
         )
         return losses
 
+    def _average_across_ranks(self, value: float) -> float:
+        """Average a scalar over all processes of a distributed run.
+
+        Every rank then sees the exact same loss, so they all make the same
+        early stopping decision and none leaves the collectives early.
+        """
+        if not self.distributed:
+            return value
+        value = torch.tensor(value, device=self.device)
+        dist.all_reduce(value)
+        return (value / self.world_size).item()
+
     def _run_training(
         self,
         train_loader,
@@ -272,33 +467,50 @@ class Forecaster:
         best_loss = 1e7
         losses = []
         min_epochs = 10
+        # early stopping can't trigger before min_epochs, so until the last
+        # `patience` epochs before it, only validate every eval_every epochs
+        eval_every = max(1, min_epochs // 5)
+        # only the first process reports progress in distributed training
+        verbose = verbose if self.rank == 0 else 0
         for epoch in range(max_epochs):
             self.net.train()
-            for data in train_loader:
-                X, y = data[0].to(device), data[1].to(device)
-                preds = self.net(X)
-                loss = self.criterion(y, preds)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-
-            current_loss = loss.item()
-
+            train_loader.set_epoch(epoch)
+            for X, y in train_loader:
+                self.optimizer.zero_grad(set_to_none=True)
+                with torch.autocast(
+                    device_type="cuda", dtype=torch.float16, enabled=USE_AMP
+                ):
+                    preds = self.net(X)
+                    loss = F.mse_loss(preds, y)
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+
+            current_loss = self._average_across_ranks(loss.item())
+
+            # on skipped epochs nothing was measured, so history and patience
+            # are left alone
+            should_validate = (
+                valid_loader is None
+                or epoch >= min_epochs - patience
+                or epoch % eval_every == 0
+            )
             if use_early_stopping:
-                if valid_loader is not None:
-                    current_loss = get_loss(
-                        self.net, device, valid_loader, self.criterion
-                    )
-                losses.append({"epoch": epoch, "loss": current_loss})
-                if current_loss < best_loss:
-                    trigger_times = 0
-                    best_loss = current_loss
-                else:
-                    trigger_times += 1
-                    if trigger_times >= patience and epoch >= min_epochs:
-                        if verbose == 1:
-                            print(f"Early stopping after {epoch=}!")
-                        return losses
+                if should_validate:
+                    if valid_loader is not None:
+                        current_loss = self._average_across_ranks(
+                            get_loss(self.net, self.device, valid_loader)
+                        )
+                    losses.append({"epoch": epoch, "loss": current_loss})
+                    if current_loss < best_loss:
+                        trigger_times = 0
+                        best_loss = current_loss
+                    else:
+                        trigger_times += 1
+                        if trigger_times >= patience and epoch >= min_epochs:
+                            if verbose == 1:
+                                print(f"Early stopping after {epoch=}!")
+                            return losses
 
             else:
                 losses.append({"epoch": epoch, "loss": current_loss})
@@ -311,26 +523,56 @@ class Forecaster:
 
         return losses
 
-    def predict(self, data):
-        X = self._get_X_and_y(data, is_train=False)[0]
-        pred_X = torch.FloatTensor(X)
-        # Initialize dataset and dataloader with only X
-        pred_dataset = CustomDataset(pred_X)
-        pred_loader = DataLoader(
-            dataset=pred_dataset, batch_size=int(self.batch_size), shuffle=False
-        )
+    def _to_device_batch(self, batch):
+        """Copy a batch to the device.
+
+        On GPU the batch is staged through reusable buffers of exactly
+        `batch_size` rows, so the constant shape and buffer address let the
+        compiled graph be reused. Rows past the batch length then hold filler
+        values and should be dropped from the output. On CPU nothing is
+        compiled, so the batch is used as is.
+        """
+        if not PIN_MEMORY:
+            return batch.to(self.device)
 
-        all_preds = []
-        for data in pred_loader:
-            # Get X and send it to the device
-            X = data.to(device)
-            preds = self.net(X).detach().cpu().numpy()
-            preds = preds[:, -self.decode_len :]
-            all_preds.append(preds)
+        if self._pin_buf is None:
+            self._pin_buf = torch.empty(
+                (self.batch_size, self.feat_dim, self.encode_len), pin_memory=True
+            )
+            self._gpu_buf = torch.empty_like(self._pin_buf, device=self.device)
+            self._copy_stream = torch.cuda.Stream(device=self.device)
+
+        num_samples = batch.shape[0]
+        compute_stream = torch.cuda.current_stream(self.device)
+        # the previous transfer must be done before the pinned buffer is reused
+        self._copy_stream.synchronize()
+        self._pin_buf[:num_samples].copy_(batch)
+        with torch.cuda.stream(self._copy_stream):
+            # ... and the previous forward pass done reading the device buffer
+            self._copy_stream.wait_stream(compute_stream)
+            self._gpu_buf[:num_samples].copy_(
+                self._pin_buf[:num_samples], non_blocking=True
+            )
+        compute_stream.wait_stream(self._copy_stream)
+        return self._gpu_buf
 
-        preds = np.concatenate(all_preds, axis=0)
-        preds = np.expand_dims(preds, axis=-1)
-        return preds
+    def predict(self, data):
+        X = torch.from_numpy(self._get_X_and_y(data, is_train=False)[0])
+
+        self.net.eval()
+        # write each batch into a preallocated buffer; copying out of the net's
+        # output also keeps it safe from being overwritten by a graph replay
+        preds = torch.empty((X.shape[0], self.decode_len, 1), device=self.device)
+        with torch.inference_mode():
+            for start in range(0, X.shape[0], self.batch_size):
+                batch = X[start : start + self.batch_size]
+                num_samples = batch.shape[0]
+                output = self.net(self._to_device_batch(batch))
+                preds[start : start + num_samples, :, 0] = output[
+                    :num_samples, -self.decode_len :
+                ]
+
+        return preds.cpu().numpy()
 
     def summary(self):
         self.model.summary()
@@ -339,27 +581,55 @@ class Forecaster:
         """Evaluate the model and return the loss and metrics"""
         x_test, y_test = self._get_X_and_y(test_data, is_train=True)
         if self.net is not None:
-            x_test, y_test = torch.FloatTensor(x_test), torch.FloatTensor(y_test)
+            x_test, y_test = torch.from_numpy(x_test), torch.from_numpy(y_test)
             dataset = CustomDataset(x_test, y_test)
-            data_loader = DataLoader(dataset=dataset, batch_size=32, shuffle=False)
-            current_loss = get_loss(self.net, device, data_loader, self.criterion)
+            # fetch each batch with a single tensor slice instead of per-sample calls
+            data_loader = DataLoader(
+                dataset=dataset,
+                sampler=BatchSampler(
+                    SequentialSampler(dataset), batch_size=32, drop_last=False
+                ),
+                batch_size=None,
+                # batches are single slices, cheaper than shipping from workers
+                num_workers=0,
+                pin_memory=PIN_MEMORY,
+            )
+            self.net.eval()
+            current_loss = get_loss(self.net, self.device, data_loader)
             return current_loss
 
     def save(self, model_path):
+        # in distributed training only the first process writes the artifacts
+        if self.rank == 0:
+            self._save(model_path)
+        if self.distributed:
+            dist.barrier()
+
+    def _save(self, model_path):
         model_params = {
             "encode_len": self.encode_len,
             "decode_len": self.decode_len,
             "feat_dim": self.feat_dim,
             "activation": self.activation,
+            "layout_version": NET_LAYOUT_VERSION,
         }
         joblib.dump(model_params, os.path.join(model_path, MODEL_PARAMS_FNAME))
-        torch.save(self.net.state_dict(), os.path.join(model_path, MODEL_WTS_FNAME))
+        torch.save(
+            unwrap_net(self.net).state_dict(),
+            os.path.join(model_path, MODEL_WTS_FNAME),
+        )
 
     @classmethod
     def load(cls, model_path):
         model_params = joblib.load(os.path.join(model_path, MODEL_PARAMS_FNAME))
+        layout_version = model_params.pop("layout_version", 1)
+        if layout_version != NET_LAYOUT_VERSION:
+            raise ValueError(
+                f"Saved model has weight layout version {layout_version}, but "
+                f"version {NET_LAYOUT_VERSION} is required. Retrain the model."
+            )
         classifier = cls(**model_params)
-        classifier.net.load_state_dict(
+        unwrap_net(classifier.net).load_state_dict(
             torch.load(os.path.join(model_path, MODEL_WTS_FNAME))
         )
         return classifier
@@ -420,8 +690,8 @@ def save_predictor_model(model: Forecaster, predictor_dir_path: str) -> None:
         model (Forecaster): The Forecaster model to save.
         predictor_dir_path (str): Dir path to which to save the model.
     """
-    if not os.path.exists(predictor_dir_path):
-        os.makedirs(predictor_dir_path)
+    # exist_ok so concurrent distributed ranks don't race on creating it
+    os.makedirs(predictor_dir_path, exist_ok=True)
     model.save(predictor_dir_path)
 
 
@@ -471,7 +741,7 @@ if __name__ == "__main__":
     )
     model.to(device=device)
 
-    X = torch.from_numpy(np.random.randn(N, encode_len, D).astype(np.float32)).to(device)
+    X = torch.from_numpy(np.random.randn(N, D, encode_len).astype(np.float32)).to(device)
 
     print(model)
 